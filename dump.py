@@ -5,15 +5,24 @@ import os
 import datetime
 import pickle
 import shutil
+import struct
+import time
 from pathlib import Path
-from typing import Iterable, Union, Tuple, Any, Generator, List
+from typing import Iterable, Union, Tuple, Any, Generator, List, Optional
 
 import msgpack  # type: ignore
+import msgpack.fallback  # type: ignore
 import sys
 import argparse
 
 from tqdm import tqdm
 
+# Optional, only used by --follow. Without it, --follow polls instead.
+try:
+    import inotify_simple  # type: ignore
+except ImportError:
+    inotify_simple = None
+
 
 # A function to split a string into parts and join with slashes
 def fourslashes(s: str) -> str:
@@ -72,9 +81,57 @@ parser.add_argument("-un", "--username", help="Filter by actual username")
 parser.add_argument(
     "-i", "--info", action="store_true", help="Only show basic info, without the tree"
 )
+
+# Browse the tree instead of exporting it
+parser.add_argument(
+    "-b",
+    "--browse",
+    nargs="?",
+    const=".",
+    help="List the contents of a directory in the space (ls-style). Default: .",
+)
+parser.add_argument(
+    "-c",
+    "--cached-index",
+    action="store_true",
+    help="Reuse the node index saved with --prefix, saving it first if missing",
+)
+
+# Copy each blob only once
+parser.add_argument(
+    "-d",
+    "--dedupe",
+    action="store_true",
+    help="Copy files sharing a blob only once, hardlinking the other paths to it",
+)
+
+# Keep running and mirror changes as they happen
+parser.add_argument(
+    "-f",
+    "--follow",
+    action="store_true",
+    help="After the export, keep watching the spaces and copy changed files",
+)
+parser.add_argument(
+    "--interval",
+    type=float,
+    default=10,
+    help="Seconds between checks for changes in --follow mode. Default: 10",
+)
 # TODO: add ability to verify/fix symlinks in topdir (personal need, from a bad copy operation)
 # Parse the command-line arguments
 ARGS = parser.parse_args()
+# --follow mirrors from a fresh export, so it needs one that copies and
+# builds the index now
+if ARGS.follow:
+    for flag, given in (
+        ("--list", ARGS.list),
+        ("--info", ARGS.info),
+        ("--browse", ARGS.browse is not None),
+        ("--cached-index", ARGS.cached_index),
+    ):
+        if given:
+            parser.error(f"{flag} cannot be used with --follow")
 
 # Define the top directory for the output
 OUTTOP = "/tmp/ocis-dump-" + datetime.datetime.now().strftime("%Y%m%d%H%M%S")
@@ -102,6 +159,149 @@ def _load_mpk_decoded(file: Path):
         raise ValueError(f"Unpack failed for file: {file}")
 
 
+# True when msgpack runs without its C extension (PyPy, no wheel for the
+# platform). Only then is scanning for a few keys faster than a full decode.
+_MPK_PURE_PYTHON = msgpack.Unpacker is msgpack.fallback.Unpacker
+
+# Fixed sizes of msgpack types that can be skipped without reading a length:
+# nil, bool, float, (u)int, fixext
+_MPK_FIXED_SIZE = {
+    0xC0: 1,
+    0xC2: 1,
+    0xC3: 1,
+    0xCA: 5,
+    0xCB: 9,
+    0xCC: 2,
+    0xCD: 3,
+    0xCE: 5,
+    0xCF: 9,
+    0xD0: 2,
+    0xD1: 3,
+    0xD2: 5,
+    0xD3: 9,
+    0xD4: 3,
+    0xD5: 4,
+    0xD6: 6,
+    0xD7: 10,
+    0xD8: 18,
+}
+# Size of the length field of bin/str/ext types
+_MPK_RAW_LENGTH = {
+    0xC4: 1,
+    0xD9: 1,
+    0xC5: 2,
+    0xDA: 2,
+    0xC6: 4,
+    0xDB: 4,
+}
+_MPK_EXT_LENGTH = {0xC7: 1, 0xC8: 2, 0xC9: 4}
+_MPK_LENGTH_FORMAT = {1: ">B", 2: ">H", 4: ">I"}
+
+
+def _mpk_container(buf: bytes, pos: int) -> Tuple[int, int]:
+    # If buf[pos] starts an array/map, return (number of objects, offset of
+    # the first one), otherwise (-1, pos)
+    b = buf[pos]
+    if 0x80 <= b <= 0x8F:
+        return 2 * (b & 0x0F), pos + 1
+    if 0x90 <= b <= 0x9F:
+        return b & 0x0F, pos + 1
+    if b == 0xDC:
+        return struct.unpack_from(">H", buf, pos + 1)[0], pos + 3
+    if b == 0xDD:
+        return struct.unpack_from(">I", buf, pos + 1)[0], pos + 5
+    if b == 0xDE:
+        return 2 * struct.unpack_from(">H", buf, pos + 1)[0], pos + 3
+    if b == 0xDF:
+        return 2 * struct.unpack_from(">I", buf, pos + 1)[0], pos + 5
+    return -1, pos
+
+
+def _mpk_raw(buf: bytes, pos: int) -> Tuple[int, int]:
+    # If buf[pos] starts a str/bin, return (offset of the data, its length),
+    # otherwise (-1, 0)
+    b = buf[pos]
+    if 0xA0 <= b <= 0xBF:
+        return pos + 1, b & 0x1F
+    size = _MPK_RAW_LENGTH.get(b)
+    if size is None:
+        return -1, 0
+    length = struct.unpack_from(_MPK_LENGTH_FORMAT[size], buf, pos + 1)[0]
+    return pos + 1 + size, length
+
+
+def _skip_mpk_object(buf: bytes, pos: int) -> int:
+    # Return the offset just past the object starting at pos, without
+    # decoding it
+    pending = 1
+    while pending:
+        pending -= 1
+        b = buf[pos]
+        if b <= 0x7F or b >= 0xE0:
+            pos += 1
+            continue
+        count, start = _mpk_container(buf, pos)
+        if count >= 0:
+            pending += count
+            pos = start
+            continue
+        start, length = _mpk_raw(buf, pos)
+        if start >= 0:
+            pos = start + length
+            continue
+        if b in _MPK_FIXED_SIZE:
+            pos += _MPK_FIXED_SIZE[b]
+            continue
+        size = _MPK_EXT_LENGTH.get(b)
+        if size is None:
+            raise ValueError(f"Invalid msgpack type 0x{b:02x} at offset {pos}")
+        length = struct.unpack_from(_MPK_LENGTH_FORMAT[size], buf, pos + 1)[0]
+        pos += 1 + size + 1 + length
+    if pos > len(buf):
+        raise ValueError("Truncated msgpack data")
+    return pos
+
+
+def _scan_mpk(file: Path, keys: Iterable[bytes]) -> dict[bytes, Any]:
+    # Like _load_mpk_decoded, but only returns the given keys. With the pure
+    # Python msgpack everything else in the map is stepped over without being
+    # unpacked; the C extension decodes the whole map faster than that.
+    wanted = set(keys)
+    found: dict[bytes, Any] = {}
+    with open(file, "rb") as f:
+        buf = f.read()
+    if not _MPK_PURE_PYTHON:
+        try:
+            mpk = msgpack.unpackb(buf, raw=True)
+        except ValueError:
+            raise ValueError(f"Unpack failed for file: {file}")
+        if not isinstance(mpk, dict):
+            raise ValueError(f"Unpack failed for file: {file}")
+        return {key: mpk[key] for key in wanted if key in mpk}
+    try:
+        if not (0x80 <= buf[0] <= 0x8F or buf[0] in (0xDE, 0xDF)):
+            raise ValueError("Not a msgpack map")
+        count, pos = _mpk_container(buf, 0)
+        for _ in range(count // 2):
+            start, length = _mpk_raw(buf, pos)
+            if start < 0:
+                # Non-string key, nothing we are looking for
+                pos = _skip_mpk_object(buf, _skip_mpk_object(buf, pos))
+                continue
+            key = buf[start : start + length]
+            pos = start + length
+            value_end = _skip_mpk_object(buf, pos)
+            if key in wanted:
+                found[key] = msgpack.unpackb(buf[pos:value_end], raw=True)
+                wanted.discard(key)
+                if not wanted:
+                    break
+            pos = value_end
+    except (IndexError, struct.error, ValueError, msgpack.UnpackException):
+        raise ValueError(f"Unpack failed for file: {file}")
+    return found
+
+
 user_exists = False
 
 # TODO: replace for-loop and "if 'nodes'" with Path.glob()
@@ -274,8 +474,15 @@ def gen_node_info(path: Path) -> Iterable[Path]:
     return node_dir, space_id, root_id
 
 
+def node_id_from_mpk(path: Path) -> str:
+    # Reverse of fourslashes: nodes/ab/cd/ef/gh/rest.mpk -> abcdefghrest
+    return "".join(path.parts[-5:-1]) + path.name.split(".")[0]
+
+
 def gen_mpk_info(path: Path) -> Iterable[str]:
-    mpk = _load_mpk_decoded(path)
+    mpk = _scan_mpk(
+        path, (b"user.ocis.parentid", b"user.ocis.blobid", b"user.ocis.name")
+    )
     parent_id = mpk.get(b"user.ocis.parentid")
     blob_id = mpk.get(b"user.ocis.blobid", b"N/A")
     name = mpk.get(b"user.ocis.name", b"N/A")
@@ -303,39 +510,544 @@ def save_state(file: Path, obj: Any):
         pickle.dump(obj, f)
 
 
-def find_files_and_parents(
-    node_mpks: Iterable[Path], space_id: str, parent_node: Path
-) -> dict[str, Tuple[str, str]]:
-    files_and_parents: dict[str, Tuple[str, str]] = {}
-    # i = 0
+def build_child_index(
+    node_mpks: Iterable[Path],
+) -> Tuple[dict[str, Tuple[Optional[str], str, str]], dict[str, Tuple[str, ...]]]:
+    # Single decode pass over all mpk files. Returns
+    #   nodes:    node_id -> (parent_id, blob_id, name)
+    #   children: parent_id -> child node_ids, sorted by name
+    nodes: dict[str, Tuple[Optional[str], str, str]] = {}
+    # Plain "<id>.mpk" files first, so that the dated variants are only used
+    # for nodes which have nothing else
     for individual_mpk in tqdm(
-        node_mpks, leave=False, desc="Finding all files", disable=False
+        sorted(node_mpks, key=lambda p: p.name.count(".")),
+        leave=False,
+        desc="Indexing nodes",
     ):
-        _, blob_id, _ = gen_mpk_info(individual_mpk)
-        # Make sure blobid is available
-        if blob_id == b"N/A":
+        node_id = node_id_from_mpk(individual_mpk)
+        if node_id in nodes:
+            continue
+        try:
+            parent_id, blob_id, name = gen_mpk_info(individual_mpk)
+        except ValueError:
+            print(f"Unpack failed for mpk {individual_mpk}")
             continue
-        files_and_parents = files_and_parents | find_parents(
-            individual_mpk, space_id, parent_node
+        nodes[node_id] = (parent_id, blob_id, name)
+    return nodes, index_children(nodes)
+
+
+def index_children(
+    nodes: dict[str, Tuple[Optional[str], str, str]],
+) -> dict[str, Tuple[str, ...]]:
+    # parent_id -> child node_ids, sorted by name. Derived from the parent
+    # pointers, so only `nodes` needs to be saved.
+    children: dict[str, List[str]] = {}
+    for node_id, (parent_id, _, _) in nodes.items():
+        if parent_id is not None:
+            children.setdefault(parent_id, []).append(node_id)
+    return {
+        parent_id: tuple(sorted(child_ids, key=lambda c: nodes[c][2]))
+        for parent_id, child_ids in children.items()
+    }
+
+
+def load_child_index(
+    file: Path, node_dir: Path, cached: bool = False
+) -> Tuple[dict[str, Tuple[Optional[str], str, str]], dict[str, Tuple[str, ...]]]:
+    # Only touches the saved index when asked to (cached): it is loaded if it
+    # exists, otherwise built and saved for the next run
+    if cached:
+        try:
+            nodes = check_for_saved_file(file=file)
+            return nodes, index_children(nodes)
+        except FileNotFoundError:
+            print(f"No saved index at {file}, building it")
+    nodes, children = build_child_index(find_all_mpks(node_dir))
+    if cached:
+        save_state(file=file, obj=nodes)
+    return nodes, children
+
+
+def walk_tree(
+    children: dict[str, Tuple[str, ...]], top_id: str
+) -> Generator[str, None, None]:
+    # Depth-first, in directory order
+    seen = {top_id}
+    stack = list(reversed(children.get(top_id, ())))
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen:
+            continue
+        seen.add(node_id)
+        yield node_id
+        stack.extend(reversed(children.get(node_id, ())))
+
+
+def resolve_path(
+    node_id: str,
+    tree: dict[str, Tuple[Optional[str], str, str]],
+    space_id: str,
+    path_cache: dict[str, str],
+) -> str:
+    # Follow the parent pointers up to the first directory whose path is
+    # already known, then fill in the cache on the way back down. Only
+    # directories are cached, so memory scales with folders, not files.
+    chain: List[str] = []
+    current: Optional[str] = node_id
+    while current not in path_cache:
+        if current == space_id:
+            path_cache[current] = "."
+            break
+        if current is None or current not in tree or current in chain:
+            raise FileNotFoundError(f"Node {node_id} is not connected to the space")
+        chain.append(current)
+        current = tree[current][0]
+    path = path_cache[current]
+    for dir_id in reversed(chain):
+        path = f"{path}/{tree[dir_id][2]}"
+        path_cache[dir_id] = path
+    return path
+
+
+def find_node_by_path(
+    nodes: dict[str, Tuple[Optional[str], str, str]],
+    children: dict[str, Tuple[str, ...]],
+    space_id: str,
+    rel_path: str,
+) -> str:
+    node_id = space_id
+    for part in Path(rel_path).parts:
+        if part == ".":
+            continue
+        matches = [c for c in children.get(node_id, ()) if nodes[c][2] == part]
+        if not matches:
+            raise FileNotFoundError(f"No such file or directory in space: {rel_path}")
+        node_id = matches[0]
+    return node_id
+
+
+def browse(
+    nodes: dict[str, Tuple[Optional[str], str, str]],
+    children: dict[str, Tuple[str, ...]],
+    space_id: str,
+    rel_path: str,
+    blob_dir: Path,
+) -> None:
+    dir_id = find_node_by_path(nodes, children, space_id, rel_path)
+    if dir_id not in children and nodes.get(dir_id, (None, "N/A"))[1] != "N/A":
+        raise NotADirectoryError(f"Not a directory: {rel_path}")
+    print(f"\tContents of {rel_path or '.'}:")
+    for child_id in children.get(dir_id, ()):
+        _, blob_id, name = nodes[child_id]
+        if child_id in children or blob_id == "N/A":
+            print(f"\t\t{'-':>12}  {name}/")
+            continue
+        blob_path = Path(blob_dir, fourslashes(blob_id))
+        size = blob_path.stat().st_size if blob_path.is_file() else "?"
+        print(f"\t\t{size:>12}  {name}")
+
+
+def find_files_and_parents(
+    nodes: dict[str, Tuple[Optional[str], str, str]],
+    children: dict[str, Tuple[str, ...]],
+    space_id: str,
+) -> dict[str, Tuple[Optional[str], str, str]]:
+    # Keyed by node id, so files sharing a name in different folders are all
+    # kept. Insertion order follows the tree, so exports run directory by
+    # directory. Paths are resolved on demand with resolve_path.
+    return {node_id: nodes[node_id] for node_id in walk_tree(children, space_id)}
+
+
+def find_changed_mpks(path: Path, since: float) -> List[Path]:
+    # Like find_all_mpks, but only stats the files instead of decoding them
+    mpks: List[Path] = []
+    for root, _, files in os.walk(path):
+        for file in files:
+            if not file.endswith(".mpk"):
+                continue
+            mpk = Path(root, file)
+            try:
+                if mpk.stat().st_mtime >= since:
+                    mpks.append(mpk)
+            except FileNotFoundError:
+                continue
+    return mpks
+
+
+def _tmtime_key(tmtime: Any) -> Optional[Tuple[str, str]]:
+    # user.ocis.tmtime is RFC 3339 in UTC with the trailing zeros of the
+    # nanoseconds trimmed, so the raw strings do not sort. Pad the fraction.
+    if tmtime is None:
+        return None
+    tmtime = decode_if_bytes(tmtime)
+    if not tmtime.endswith("Z"):
+        return None
+    base, _, fraction = tmtime[:-1].partition(".")
+    return base, fraction.ljust(9, "0")
+
+
+def find_changed_mpks_by_tmtime(
+    nodes_dir: Path,
+    space_id: str,
+    nodes: dict[str, Tuple[Optional[str], str, str]],
+    children: dict[str, Tuple[str, ...]],
+    since: float,
+    tmtime_after: Any,
+) -> Optional[List[Path]]:
+    # Walk down from the space root, only entering directories whose
+    # user.ocis.tmtime is newer than tmtime_after, so the cost follows the
+    # amount of change rather than the size of the space. The children of a
+    # directory come from the index plus the child symlinks in its node
+    # folder, which also finds new nodes. Only mpk files written since
+    # `since` are decoded. Returns None if a directory has no node folder to
+    # list, in which case the caller has to use find_changed_mpks instead.
+    threshold = _tmtime_key(tmtime_after)
+    mpks: List[Path] = []
+    stack = [space_id]
+    while stack:
+        dir_id = stack.pop()
+        child_ids = set(children.get(dir_id, ()))
+        try:
+            with os.scandir(Path(nodes_dir, fourslashes(dir_id))) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        target = Path(os.readlink(entry.path))
+                        child_ids.add(node_id_from_mpk(target))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        for child_id in child_ids:
+            child_mpk = Path(nodes_dir, fourslashes(child_id) + ".mpk")
+            try:
+                # Propagation rewrites the mpk of every directory it passes
+                # through, so an old mpk means nothing changed below it either
+                if child_id in nodes and child_mpk.stat().st_mtime < since:
+                    continue
+                mpk = _scan_mpk(child_mpk, (b"user.ocis.blobid", b"user.ocis.tmtime"))
+            except (FileNotFoundError, ValueError):
+                continue
+            mpks.append(child_mpk)
+            if b"user.ocis.blobid" in mpk:
+                continue
+            tmtime = _tmtime_key(mpk.get(b"user.ocis.tmtime"))
+            if tmtime is None or threshold is None or tmtime > threshold:
+                stack.append(child_id)
+    return mpks
+
+
+def _node_path(
+    node_id: str, nodes: dict[str, Tuple[Optional[str], str, str]], space_id: str
+) -> Optional[str]:
+    # Path of a node relative to the space root, or None if it is not
+    # below it (e.g. trashed)
+    parent_id, _, name = nodes[node_id]
+    try:
+        return f"{resolve_path(str(parent_id), nodes, space_id, {})}/{name}"
+    except FileNotFoundError:
+        return None
+
+
+def update_child_index(
+    nodes: dict[str, Tuple[Optional[str], str, str]],
+    children: dict[str, Tuple[str, ...]],
+    node_mpks: Iterable[Path],
+    space_id: str,
+) -> Tuple[List[str], List[Tuple[str, str, str]]]:
+    # Apply changed mpk files to an index from build_child_index in place.
+    # Returns the ids of the nodes that need to be copied again, and the
+    # (node_id, old_path, new_path) of renamed or moved nodes, in the order
+    # they were applied, so the mirror can be changed the same way.
+    changed: dict[str, None] = {}
+    copy_ids: List[str] = []
+    moves: List[Tuple[str, str, str]] = []
+    for individual_mpk in sorted(node_mpks, key=lambda p: p.name.count(".")):
+        node_id = node_id_from_mpk(individual_mpk)
+        if node_id in changed:
+            continue
+        # Same rule as build_child_index: dated variants (revisions) only
+        # stand in for nodes that have no plain "<id>.mpk"
+        plain_mpk = Path(
+            individual_mpk.parent, individual_mpk.name.split(".")[0] + ".mpk"
         )
-    return files_and_parents
-
-
-def find_parents(
-    individual_mpk: Path, space_id: str, parent_node: Path, level: int = 0
-) -> dict[str, Tuple[str, str]]:
-    files_and_parents: dict[str, Tuple[str, str]] = {}
-    # Base
-    parent_id, blob_id, name = gen_mpk_info(individual_mpk)
-    if parent_id == space_id:
-        files_and_parents[name] = (".", blob_id)
-    elif parent_id is not None and parent_id != space_id:
-        parent_path = Path(parent_node, fourslashes(parent_id))
-        parent_mpk = find_mpk(parent_path)
-        parents = find_parents(parent_mpk, space_id, parent_node, level + 1)
-        parent_name = [k for k in parents][0]
-        files_and_parents[name] = (f"{parents[parent_name][0]}/{parent_name}", blob_id)
-    return files_and_parents
+        if individual_mpk.name.count(".") > 1 and (
+            node_id in nodes or plain_mpk.exists()
+        ):
+            continue
+        try:
+            parent_id, blob_id, name = gen_mpk_info(individual_mpk)
+        except (ValueError, FileNotFoundError):
+            print(f"Unpack failed for mpk {individual_mpk}")
+            continue
+        old = nodes.get(node_id)
+        # Directories are rewritten whenever tmtime/treesize propagates
+        # through them, and new content always gets a new blob, so an
+        # unchanged entry needs no copying. This also makes it cheap for
+        # poll_space to look at the same mpk files twice.
+        if old == (parent_id, blob_id, name):
+            continue
+        changed[node_id] = None
+        old_path = _node_path(node_id, nodes, space_id) if old else None
+        nodes[node_id] = (parent_id, blob_id, name)
+        if old is not None and old[0] != parent_id and old[0] in children:
+            children[old[0]] = tuple(c for c in children[old[0]] if c != node_id)
+        if parent_id is not None:
+            siblings = set(children.get(parent_id, ()))
+            siblings.add(node_id)
+            children[parent_id] = tuple(sorted(siblings, key=lambda c: nodes[c][2]))
+        new_path = _node_path(node_id, nodes, space_id)
+        if old is not None and old_path is not None and new_path is not None:
+            if old_path != new_path:
+                moves.append((node_id, old_path, new_path))
+            # A moved directory keeps its contents, a moved file its blob
+            if old[1] == blob_id and old_path != new_path:
+                continue
+        copy_ids.append(node_id)
+    return copy_ids, moves
+
+
+def _rebase_mirrored(
+    space: dict[str, Any], old_path: Path, new_path: Path
+) -> None:
+    # Keep the --dedupe bookkeeping pointing at files that were moved
+    def rebase(path: Path) -> Path:
+        if path == old_path or old_path in path.parents:
+            return Path(new_path, path.relative_to(old_path))
+        return path
+
+    space["mirrored_blobs"] = {
+        rebase(path): blob_id for path, blob_id in space["mirrored_blobs"].items()
+    }
+    space["exported_blobs"] = {
+        blob_id: rebase(path) for blob_id, path in space["exported_blobs"].items()
+    }
+
+
+def move_mirrored(
+    moves: Iterable[Tuple[str, str, str]], space: dict[str, Any]
+) -> List[str]:
+    # Rename mirrored files and directories instead of copying them again.
+    # Returns the ids of the nodes that could not be moved, to be copied.
+    failed: List[str] = []
+    for node_id, old_path, new_path in moves:
+        source = Path(space["out_dir"], old_path)
+        target = Path(space["out_dir"], new_path)
+        if not source.exists():
+            failed.append(node_id)
+            continue
+        target.parent.mkdir(mode=0o660, parents=True, exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError:
+            # e.g. a non-empty directory is already at the new path. Drop the
+            # old copy, the node gets copied to the new path instead.
+            if source.is_dir():
+                shutil.rmtree(source)
+            else:
+                source.unlink(missing_ok=True)
+            failed.append(node_id)
+            continue
+        _rebase_mirrored(space, source, target)
+        print(f"\t{Path(old_path)} -> {Path(new_path)}")
+    return failed
+
+
+def mirror_nodes(
+    node_ids: Iterable[str], space: dict[str, Any], dedupe: bool = False
+) -> int:
+    # Copy the given nodes, and everything below them (for directories that
+    # are new in the space or could not be moved), into the space's out_dir.
+    # Returns the number of files written.
+    nodes, children = space["nodes"], space["children"]
+    # blob_id -> first path it was written to, and path -> blob_id last
+    # written there, so a link is only made to a path that still has the blob
+    exported_blobs: dict[str, Path] = space["exported_blobs"]
+    mirrored_blobs: dict[Path, str] = space["mirrored_blobs"]
+    path_cache: dict[str, str] = {}
+    done = set()
+    copied = 0
+    for top_id in node_ids:
+        for node_id in [top_id, *walk_tree(children, top_id)]:
+            if node_id in done:
+                continue
+            done.add(node_id)
+            parent_id, blob_id, name = nodes[node_id]
+            blob_path = Path(space["node_dir"], "blobs", fourslashes(blob_id))
+            if not blob_path.is_file():
+                continue
+            try:
+                parent_path = resolve_path(
+                    str(parent_id), nodes, space["space_id"], path_cache
+                )
+            except FileNotFoundError:
+                # Not (or no longer) below the space root, e.g. trashed
+                continue
+            write_path = Path(space["out_dir"], parent_path, name)
+            write_path.parent.mkdir(mode=0o660, parents=True, exist_ok=True)
+            # With --dedupe the old file may be hardlinked to other paths, and
+            # copying into it would change all of them
+            write_path.unlink(missing_ok=True)
+            first_path = exported_blobs.get(blob_id)
+            if (
+                dedupe
+                and first_path is not None
+                and first_path != write_path
+                and mirrored_blobs.get(first_path) == blob_id
+                and first_path.is_file()
+            ):
+                link_or_copy(first_path, write_path)
+            else:
+                shutil.copy2(blob_path, write_path)
+                exported_blobs[blob_id] = write_path
+            mirrored_blobs[write_path] = blob_id
+            print(f"\t{Path(parent_path, name)}")
+            copied += 1
+    return copied
+
+
+def watch_nodes(nodes_dirs: Iterable[Path]) -> Any:
+    # Returns (inotify, wd -> directory), or None if inotify is unavailable
+    # or runs out of watches, in which case the caller should poll
+    if inotify_simple is None:
+        return None
+    flags = inotify_simple.flags
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    inotify = inotify_simple.INotify()
+    watches: dict[int, Path] = {}
+    try:
+        for nodes_dir in nodes_dirs:
+            for root, _, _ in os.walk(nodes_dir):
+                watches[inotify.add_watch(root, mask)] = Path(root)
+    except OSError as e:
+        print(f"Cannot watch {nodes_dir} ({e}), polling instead")
+        inotify.close()
+        return None
+    return inotify, watches
+
+
+def read_watched_mpks(
+    inotify: Any, watches: dict[int, Path], timeout: float
+) -> Optional[List[Path]]:
+    # Wait up to timeout seconds for changes, and return the mpk files
+    # that were written or moved in. New directories get watched too.
+    # Returns None if the kernel dropped events, in which case the caller
+    # has to rescan. Raises OSError if no more watches can be added.
+    flags = inotify_simple.flags
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    mpks: List[Path] = []
+    for event in inotify.read(timeout=int(timeout * 1000)):
+        if event.mask & flags.Q_OVERFLOW:
+            print("Too many changes at once for inotify, rescanning")
+            return None
+        if event.wd not in watches:
+            continue
+        path = Path(watches[event.wd], event.name)
+        if event.mask & flags.ISDIR:
+            # Anything written before the watch was added would be missed
+            for root, _, files in os.walk(path):
+                try:
+                    watches[inotify.add_watch(root, mask)] = Path(root)
+                except (FileNotFoundError, NotADirectoryError):
+                    # Removed again while walking
+                    continue
+                mpks.extend(Path(root, f) for f in files if f.endswith(".mpk"))
+        elif event.name.endswith(".mpk"):
+            mpks.append(path)
+    return mpks
+
+
+def follow(
+    followed: List[dict[str, Any]], interval: float, dedupe: bool = False
+) -> None:
+    # followed holds one dict per space, see main. Uses inotify when
+    # available. Otherwise it polls the root's user.ocis.tmtime, which
+    # changes whenever anything below it does, and when it moved walks down
+    # through the directories with a newer tmtime. The first pass always
+    # polls, to catch up on whatever changed during the export.
+    watcher = watch_nodes(Path(space["node_dir"], "nodes") for space in followed)
+    print("Following changes" + (" (inotify)" if watcher else " (polling)"))
+    changed_mpks: List[Path] = []
+    catch_up = True
+    try:
+        while True:
+            if watcher and not catch_up:
+                try:
+                    watched_mpks = read_watched_mpks(*watcher, timeout=interval)
+                except OSError as e:
+                    print(f"Cannot watch new directories ({e}), polling instead")
+                    watcher[0].close()
+                    watcher = None
+                    watched_mpks = None
+                if watched_mpks is None:
+                    catch_up = True
+                else:
+                    changed_mpks = watched_mpks
+            elif not catch_up:
+                time.sleep(interval)
+            for space in followed:
+                node_dir = space["node_dir"]
+                if watcher and not catch_up:
+                    space_mpks = [m for m in changed_mpks if node_dir in m.parents]
+                else:
+                    space_mpks = poll_space(space)
+                node_ids, moves = update_child_index(
+                    space["nodes"], space["children"], space_mpks, space["space_id"]
+                )
+                node_ids += move_mirrored(moves, space)
+                if node_ids or moves:
+                    copied = mirror_nodes(node_ids, space, dedupe=dedupe)
+                    print(
+                        f"{datetime.datetime.now():%H:%M:%S} "
+                        f"moved {len(moves)}, copied {copied} files"
+                    )
+            catch_up = False
+    except KeyboardInterrupt:
+        print("Stopped following")
+    finally:
+        if watcher:
+            watcher[0].close()
+
+
+def poll_space(space: dict[str, Any]) -> List[Path]:
+    # Changed mpk files of one space, guided by user.ocis.tmtime. Without
+    # tmtime (propagation disabled) or node folders, stats every mpk instead.
+    # The cut-offs only move after a real walk, and lag one walk behind, so
+    # mpk files written while propagation was still on its way up to the
+    # root are looked at again by the next walk.
+    try:
+        tmtime = _scan_mpk(space["root_mpk"], (b"user.ocis.tmtime",))
+    except (ValueError, FileNotFoundError):
+        tmtime = {}
+    root_tmtime = tmtime.get(b"user.ocis.tmtime")
+    if root_tmtime is not None and root_tmtime == space["last_tmtime"]:
+        return []
+    walk_start = time.time()
+    nodes_dir = Path(space["node_dir"], "nodes")
+    mpks = None
+    if root_tmtime is not None:
+        mpks = find_changed_mpks_by_tmtime(
+            nodes_dir,
+            space["space_id"],
+            space["nodes"],
+            space["children"],
+            space["since"],
+            space["tmtime_after"],
+        )
+    if mpks is None:
+        mpks = find_changed_mpks(nodes_dir, space["since"])
+    space["since"], space["last_walk"] = space["last_walk"], walk_start
+    space["tmtime_after"], space["last_tmtime"] = space["last_tmtime"], root_tmtime
+    return mpks
+
+
+def link_or_copy(source: Path, target: Path) -> bool:
+    # Returns True if a hardlink was made, False if it had to fall back to a
+    # copy (e.g. the first copy is on another filesystem)
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+        return True
+    except OSError:
+        shutil.copy2(source, target)
+        return False
 
 
 def main(sprefix: str = SPREFIX, args: argparse.Namespace = ARGS) -> None:
@@ -353,6 +1065,8 @@ def main(sprefix: str = SPREFIX, args: argparse.Namespace = ARGS) -> None:
         raise NotADirectoryError(f"'storage' folder not found in {top}")
     print(f"top is: {top}")
     user_exists = False
+    followed: List[dict[str, Any]] = []
+    follow_since = time.time()
 
     # Get all nodes
     nodes = find_nodes(path=Path(top, sprefix))
@@ -386,11 +1100,11 @@ def main(sprefix: str = SPREFIX, args: argparse.Namespace = ARGS) -> None:
         print(f"\ttree size = {tree_size} {size_type}")
         if args.info:
             continue
-        print("\tsymlink_tree =")
 
         # Go through the node and match all files
         node_prefix = Path(args.prefix + f"node_{space_user}")
         files_prefix = Path(args.prefix + f"files_{space_user}")
+        index_prefix = Path(args.prefix + f"index_{space_user}")
         # try:
         #     node_mpks = check_for_saved_file(file=node_prefix)
         # except FileNotFoundError:
@@ -403,19 +1117,44 @@ def main(sprefix: str = SPREFIX, args: argparse.Namespace = ARGS) -> None:
         #         node_mpks=node_mpks, space_id=str(space_id), parent_node=node
         #     )
         #     save_state(file=files_prefix, obj=files_and_parents)
-        node_mpks = find_all_mpks(node_dir)
+        nodes, children = load_child_index(
+            file=index_prefix, node_dir=node_dir, cached=args.cached_index
+        )
+        if args.browse is not None:
+            try:
+                browse(
+                    nodes=nodes,
+                    children=children,
+                    space_id=str(space_id),
+                    rel_path=args.browse,
+                    blob_dir=Path(node_dir, "blobs"),
+                )
+            except (FileNotFoundError, NotADirectoryError) as e:
+                print(f"\t{e}")
+            continue
+        print("\tsymlink_tree =")
         files_and_parents = find_files_and_parents(
-            node_mpks=node_mpks, space_id=str(space_id), parent_node=node
+            nodes=nodes, children=children, space_id=str(space_id)
         )
+        path_cache: dict[str, str] = {}
+        # blob_id -> first path it was written to
+        exported_blobs: dict[str, Path] = {}
+        copied_bytes = 0
+        copy_seconds = 0.0
+        linked_files = 0
+        linked_bytes = 0
         blob_file = 0
         blob_folder = 0
-        for i, (name, (parent_path, blob_id)) in tqdm(
+        for i, (node_id, (parent_id, blob_id, name)) in tqdm(
             enumerate(files_and_parents.items(), start=1),
             leave=False,
             desc="Constructing paths",
             disable=True,
         ):
             blob_path = Path(node_dir, "blobs", fourslashes(blob_id))
+            parent_path = resolve_path(
+                str(parent_id), files_and_parents, str(space_id), path_cache
+            )
 
             if blob_path.exists():
                 blob_file += 1
@@ -429,13 +1168,62 @@ def main(sprefix: str = SPREFIX, args: argparse.Namespace = ARGS) -> None:
                     write_path = Path(args.outdir, full_path)
                     write_path.parent.mkdir(mode=0o660, parents=True, exist_ok=True)
                     print(f"\t\tCreated {write_path.parent}")
-                    if blob_path.is_file():
-                        shutil.copy2(blob_path, write_path)
-                        print(f"\t\tSaved {write_path.name}")
+                    if not blob_path.is_file():
+                        continue
+                    if args.dedupe and blob_id in exported_blobs:
+                        first_path = exported_blobs[blob_id]
+                        start = time.perf_counter()
+                        if link_or_copy(first_path, write_path):
+                            linked_files += 1
+                            linked_bytes += blob_path.stat().st_size
+                            print(f"\t\tLinked {write_path.name} -> {first_path}")
+                            continue
+                        copy_seconds += time.perf_counter() - start
+                        copied_bytes += blob_path.stat().st_size
+                        print(f"\t\tCould not link, copied {write_path.name}")
+                        continue
+                    # A previous --dedupe run may have left a hardlink here,
+                    # and copying into it would change the other paths too
+                    write_path.unlink(missing_ok=True)
+                    start = time.perf_counter()
+                    shutil.copy2(blob_path, write_path)
+                    copy_seconds += time.perf_counter() - start
+                    copied_bytes += blob_path.stat().st_size
+                    exported_blobs[blob_id] = write_path
+                    print(f"\t\tSaved {write_path.name}")
             else:
                 blob_folder += 1
                 print(f"\t{i}\t{parent_path}/{name}\t(directory)")
         print(f"Files: {blob_file}\nFolders: {blob_folder}")
+        if args.follow:
+            followed.append(
+                {
+                    "node_dir": node_dir,
+                    "space_id": str(space_id),
+                    "root_mpk": root_mpk,
+                    # Cut-offs for poll_space, see there
+                    "since": follow_since,
+                    "last_walk": follow_since,
+                    "tmtime_after": root_mpk_contents.get(b"user.ocis.tmtime"),
+                    "last_tmtime": root_mpk_contents.get(b"user.ocis.tmtime"),
+                    "out_dir": Path(args.outdir, space_type, space_user),
+                    "nodes": nodes,
+                    "children": children,
+                    "exported_blobs": exported_blobs,
+                    "mirrored_blobs": {p: b for b, p in exported_blobs.items()},
+                }
+            )
+        if args.dedupe and not args.list:
+            # Estimate the time saved from the throughput of the real copies
+            saved_seconds = (
+                linked_bytes * copy_seconds / copied_bytes if copied_bytes else 0.0
+            )
+            print(
+                f"Deduplicated: {linked_files} files hardlinked\n"
+                f"\tsaved {linked_bytes} bytes, ~{saved_seconds:.2f} s of copying"
+            )
+    if followed:
+        follow(followed, interval=args.interval, dedupe=args.dedupe)
     return
 
 